@@ -20,11 +20,10 @@ import os
 msgID = itertools.count()
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
-receiver = UBX_receiver("COM4", 115200)
-receiver.ubx_config_disable_all()
-receiver.ubx_config_enable("GGA_UART1","SFRBX_UART1", "RAWX_UART1")
-with open(os.path.join(dir_path,"output.o"), "w") as file:
-    try:
+with UBX_receiver("COM4", 115200) as receiver:
+    receiver.ubx_config_disable_all()
+    receiver.ubx_config_enable("GGA_UART1","SFRBX_UART1", "RAWX_UART1")
+    with open(os.path.join(dir_path,"output.o"), "w") as file:
         while True:
             try:
                 msg = receiver.parse()
@@ -37,8 +36,8 @@ with open(os.path.join(dir_path,"output.o"), "w") as file:
                                 "type": "GNSS",
                                 "protocol": "UBX",
                                 "timestamp": time.time(),
-                                "class": msg.cl,
-                                "id": msg.id,
+                                "class": msg.ubx_class,
+                                "id": msg.ubx_id,
                                 "payload": list(msg.payload),
                                 "raw": list(msg.raw_data)
                             }
@@ -59,6 +58,3 @@ with open(os.path.join(dir_path,"output.o"), "w") as file:
                     file.flush()
             except (ValueError, IOError) as err:
                 print(err)
-
-    finally:
-        del receiver #clean up serial connection
\ No newline at end of file
@@ -12,89 +12,157 @@ MIT
 """
 import serial
 import logging
+import struct
+from collections import deque
+from functools import lru_cache, reduce
+from itertools import accumulate
+from operator import xor
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+log = logging.getLogger(__name__)
+
+# frame delimiters as ints, compared against bytes taken from the input buffer
+SYNC1 = 0xB5
+SYNC2 = 0x62
+DOLLAR = 0x24  # "$"
+G = 0x47  # "G"
+NL = 0x0A  # "\n"
+_UBX_START = bytes((SYNC1, SYNC2))
+_NMEA_START = bytes((DOLLAR, G))
+# class, id and little endian payload length following the sync word
+_UBX_HDR = struct.Struct('<BBH')
+_NMEA_END = bytes((NL,))
+# NMEA sentences are at most 82 characters, anything longer is garbage
+_NMEA_MAX = 256
 
 ubx_msg_dict = {
     # lookup table for ubx messages
-    b"\x01": {
+    0x01: {
         "classname": "NAV",
 
     },
-    b"\x02": {
+    0x02: {
         "classname": "RXM",
-        b"\x14": "MEASX",
-        b"\x41": "PMREQ",
-        b"\x15": "RAWX",
-        b"\x59": "RLM",
-        b"\x13": "SFRBX"
+        0x14: "MEASX",
+        0x41: "PMREQ",
+        0x15: "RAWX",
+        0x59: "RLM",
+        0x13: "SFRBX"
     },
-    b"\x04": {
+    0x04: {
         "classname": "INF",
 
     },
-    b"\x05":  {
+    0x05:  {
         "classname": "ACK",
-        b"\x00": "NAK",
-        b"\x01": "ACK"
+        0x00: "NAK",
+        0x01: "ACK"
     },
-    b"\x06":  {
+    0x06:  {
         "classname": "CFG",
 
     },
-    b"\x09":  {
+    0x09:  {
         "classname": "UPD",
 
     },
-    b"\x0A":  {
+    0x0A:  {
         "classname": "MON",
 
     },
-    b"\x0D":  {
+    0x0D:  {
         "classname": "TIM",
 
     },
-    b"\x13":  {
+    0x13:  {
         "classname": "MGA",
 
     },
-    b"\x21":  {
+    0x21:  {
         "classname": "LOG",
 
     },
-    b"\x27":  {
+    0x27:  {
         "classname": "SEC",
 
     },
 }
 
 
+if HAVE_NUMBA:
+    @njit(cache=True, boundscheck=False)
+    def _fletcher_u8(buf, start, end):
+        '''native Fletcher accumulation over buf[start:end], returns (CK_B << 8) | CK_A'''
+        a = 0
+        b = 0
+        for i in range(start, end):
+            a = (a + buf[i]) & 0xFF
+            b = (b + a) & 0xFF
+        return (b << 8) | a
+
+
+# without numba, frames this long are cheaper to checksum with numpy than
+# with the builtins below, shorter ones do not amortize numpy's call overhead
+_FLETCHER_NUMPY_MIN = 256
+
+
 def fletcher_checksum(msg):
     '''8-Bit Fletcher Algorithm modelled after ublox documentation. Returns checksum'''
-    # print(f"computing checksum of {msg}")
-    CK_A = CK_B = 0
+    if HAVE_NUMBA:
+        arr = np.frombuffer(msg, dtype=np.uint8)
+        # start at class (byte 2)
+        r = _fletcher_u8(arr, 2, arr.size)
+        return bytes([r & 0xFF, r >> 8])
+    if len(msg) >= _FLETCHER_NUMPY_MIN:
+        # CK_A is the last running sum, CK_B the sum of all of them.
+        # uint32 wraps modulo 2**32, so the low byte stays exact
+        sums = np.frombuffer(msg, dtype=np.uint8)[2:].cumsum(dtype=np.uint32)
+        return bytes([int(sums[-1]) & 0xFF,
+                      int(sums.sum(dtype=np.uint32)) & 0xFF])
     # start at class (byte 2)
-    for i in range(2, len(msg)):
-        CK_A += msg[i]
-        CK_B += CK_A
-    # mask to 8bit uint
-    CK_A &= 0xFF
-    CK_B &= 0xFF
-    # convert to bytes
-    CK_A = bytes([CK_A])
-    CK_B = bytes([CK_B])
-    # print("CK_A", CK_A)
-    # print("CK_B", CK_B)
-    return CK_A+CK_B
-
-
-def safeget(dict, *keys):
-    '''safe getmethod for nested dicts'''
-    # print(f"keys:{keys}")
-    for key in keys:
-        try:
-            dict = dict[key]
-        except KeyError:
-            return None
-    return dict
+    body = msg[2:]
+    # closed form of the two running sums, so no per-byte python loop:
+    # CK_A is the sum of all bytes, CK_B the sum of all partial sums
+    CK_A = sum(body) & 0xFF
+    CK_B = sum(accumulate(body)) & 0xFF
+    return bytes([CK_A, CK_B])
+
+
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def _nmea_xor_u8(buf):
+        '''native XOR reduction over buf'''
+        x = 0
+        for v in buf:
+            x ^= v
+        return x
+
+
+def nmea_checksum(nmea_data):
+    '''NMEA checksum, XOR sum of all characters between $ and *. Returns int'''
+    data = nmea_data.encode('ascii')
+    if HAVE_NUMBA:
+        return int(_nmea_xor_u8(np.frombuffer(data, dtype=np.uint8)))
+    return reduce(xor, data, 0)
+
+
+if HAVE_NUMBA:
+    # compile (or load from cache) at import, so the first message does not pay for it
+    fletcher_checksum(b'\xB5\x62\x00')
+    nmea_checksum("G")
+
+
+# flat int keyed views of ubx_msg_dict, built once for the message decoder
+_UBX_CLASS = {c: ids["classname"] for c, ids in ubx_msg_dict.items()}
+_UBX_NAME = {(c, id): name
+             for c, ids in ubx_msg_dict.items()
+             for id, name in ids.items() if id != "classname"}
 
 
 ubx_config_dict = {
@@ -113,157 +181,257 @@ ubx_config_dict = {
 }
 
 
+def ubx_frame(c, id, payload):
+    '''generate a valid ubx message with checksum'''
+    sync = b'\xB5\x62'
+    length = len(payload).to_bytes(2, 'little')
+    msg = sync+c+id+length+payload
+    checksum = fletcher_checksum(msg)
+    msg += checksum
+    return msg
+
+
+@lru_cache(maxsize=64)
+def _set_val_frame(*args):
+    '''CFG-VALSET frame for the given key/value pairs, built once per distinct arguments'''
+    c = b'\x06'
+    id = b'\x8A'
+    # version, layer (RAM) and 2 reserved bytes, followed by the key/value pairs
+    parts = [b'\x00\x01\x00\x00']
+    for arg in args:
+        if (type(arg) == int):
+            arg = bytes([arg])
+        elif (type(arg) == str):
+            arg = ubx_config_dict[arg]
+        parts.append(arg)
+    return ubx_frame(c, id, b''.join(parts))
+
+
+def _config_vals(keys, value):
+    '''key/value arguments for set_val, setting every config key in keys to value'''
+    vals = []
+    for key in keys:
+        vals.append(ubx_config_dict[key])
+        vals.append(value)
+    return vals
+
+
+# CFG-RST payload is fixed, build the frame once
+UBX_RESET_FRAME = ubx_frame(b'\x06', b'\x04', b'\x00\x00\x00\x00')
+
+
 class UBX_receiver:
-    serialport = None
-    baudrate = None
-    port = None
-    current_parse = None
-    parse_data = []
-    last_byte = None
 
     def __init__(self, port, baudrate):
+        self.port = None
         self.serialport = port
         self.baudrate = baudrate
+        self.current_parse = None
+        self.last_byte = -1
+        self._pending = deque()
+        # preallocated frame buffer, self._n is the write cursor
+        self._buf = bytearray(2048)
+        self._n = 0
+        # fixed input buffer the serial port is read into
+        self._inbuf = bytearray(1 << 14)
+        self._inbuf_mv = memoryview(self._inbuf)
         self.connect()
+        # frames switching every key of ubx_config_dict, built once per receiver
+        self._ALL_ENABLE = _set_val_frame(
+            *_config_vals(ubx_config_dict, b"\x01"))
+        self._ALL_DISABLE = _set_val_frame(
+            *_config_vals(ubx_config_dict, b'\x00'))
 
-    def __del__(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''close the serial connection'''
         if self.port != None:
             self.port.close()
+            self.port = None
 
     def connect(self):
         if self.port != None:
             try:
                 self.port.close()
             except Exception as err:
-                print(f"lol this should not happen: {err}")
-        logging.info(f"connectiong to {self.serialport}:{self.baudrate}")
+                log.warning("lol this should not happen: %s", err)
+        log.info("connectiong to %s:%s", self.serialport, self.baudrate)
         self.port = serial.Serial(
             self.serialport, self.baudrate)  # open serial port
 
     def reset_data(self):
-        self.parse_data = []
+        self._n = 0
         self.current_parse = None
 
     def parse(self):
-
-        while (self.port.in_waiting > 0):  # non blocking read
-            logging.debug(f"mode: {self.current_parse} data {self.parse_data}")
-            byte = self.port.read()
-            logging.debug(f"byte: {byte} lastbyte: {self.last_byte}")
+        '''drain the serial input buffer, returns the next complete message or None'''
+        while (not self._pending):
+            waiting = self.port.in_waiting
+            if (waiting == 0):  # non blocking read
+                break
+            # fetch everything that is waiting in one call instead of byte by byte
+            n = self.port.readinto(
+                self._inbuf_mv[:min(waiting, len(self._inbuf))])
+            self._consume(n)
+
+        # a single read may complete several frames, hand them out one per call
+        if (self._pending):
+            return self._pending.popleft()
+
+    def _consume(self, end):
+        '''run the frame state machine over the first end bytes of the input buffer'''
+        buf = self._inbuf
+        mv = self._inbuf_mv
+        pos = 0
+        # checked once per chunk, the message below is expensive to format
+        debug = log.isEnabledFor(logging.DEBUG)
+        # whether the last byte of the chunk was scanned while idle
+        idle_tail = False
+        while (pos < end):
+            if (debug):
+                log.debug("mode: %s data %s pos: %d/%d", self.current_parse,
+                          bytes(self._buf[:self._n]), pos, end)
             if (self.current_parse == None):
-                if (byte == b'\x62' and self.last_byte == b'\xB5'):
-                    self.current_parse = "UBX"
-                    self.parse_data = []
-                    logging.debug("received UBX start frame")
-                elif (byte == b'G' and self.last_byte == b'$'):
-                    self.current_parse = "NMEA"
-                    self.parse_data = [b'G']
-                    logging.debug("received NMEA start frame")
-                self.last_byte = byte
-                return
-
-            if (self.current_parse == "UBX"):
-                self.parse_data.append(byte)
-                if (len(self.parse_data) >= 4):
-                    length = int.from_bytes(
-                        self.parse_data[2] + self.parse_data[3], 'little')
-                    ubx_length = length
-                    if (len(self.parse_data) == (ubx_length + 6)):
-                        data_string = b''.join(self.parse_data)
-                        try:
-                            message = UBX_message(data_string)
-                        except ValueError as err:
-                            message = f"invalid ubx-message! ({err})"
-                        self.reset_data()
-                        return message
-
-            if (self.current_parse == "NMEA"):
-                self.parse_data.append(byte)
-                if (byte == b'\n'):
-                    data_string = b''.join(self.parse_data)
+                if (pos == 0 and buf[0] == SYNC2 and self.last_byte == SYNC1):
+                    # sync word split across two reads
+                    self._start_ubx()
+                    pos = 1
+                    continue
+                if (pos == 0 and buf[0] == G and self.last_byte == DOLLAR):
+                    self._start_nmea()
+                    pos = 1
+                    continue
+                # let bytes.find skip everything up to the next start frame
+                ubx = buf.find(_UBX_START, pos, end)
+                nmea = buf.find(_NMEA_START, pos, end if ubx < 0 else ubx)
+                if (nmea >= 0):
+                    self._start_nmea()
+                    pos = nmea + 2
+                elif (ubx >= 0):
+                    self._start_ubx()
+                    pos = ubx + 2
+                else:
+                    pos = end
+                    idle_tail = True
+
+            elif (self.current_parse == "UBX"):
+                # copy as much of the frame as this chunk holds in one go,
+                # first the 4 header bytes, then the rest once the length is known
+                if (self._n < 4):
+                    need = 4
+                else:
+                    need = (self._buf[2] | (self._buf[3] << 8)) + 6
+                take = min(need - self._n, end - pos)
+                self._buf[self._n:self._n + take] = mv[pos:pos + take]
+                self._n += take
+                pos += take
+                if (self._n < need):
+                    continue
+                if (need == 4):
+                    size = (self._buf[2] | (self._buf[3] << 8)) + 6
+                    if (len(self._buf) < size):
+                        # grow once for frames larger than the buffer
+                        self._buf.extend(bytes(size - len(self._buf)))
+                    continue
+                try:
+                    message = UBX_message(
+                        bytes(memoryview(self._buf)[:self._n]))
+                except ValueError as err:
+                    message = f"invalid ubx-message! ({err})"
+                self.reset_data()
+                self._pending.append(message)
+
+            elif (self.current_parse == "NMEA"):
+                # copy up to and including the line end in one go
+                nl = buf.find(_NMEA_END, pos, end)
+                take = min((end if nl < 0 else nl + 1) - pos,
+                           _NMEA_MAX - self._n)
+                self._buf[self._n:self._n + take] = mv[pos:pos + take]
+                self._n += take
+                pos += take
+                if (self._buf[self._n - 1] == NL):
                     try:
-                        message = NMEA_message(data_string)
+                        message = NMEA_message(
+                            bytes(memoryview(self._buf)[:self._n]))
                     except ValueError:
                         message = "invalid nmea-message!"
                     self.reset_data()
-                    return message
+                    self._pending.append(message)
+                elif (self._n == _NMEA_MAX):
+                    # no line end in sight, this is not a NMEA sentence
+                    self.reset_data()
+                    self._pending.append("invalid nmea-message!")
+
+        if (end):
+            # only a byte seen while idle can start a sync word split across
+            # reads, never the tail of a frame that just finished
+            self.last_byte = buf[end - 1] if idle_tail else -1
+
+    def _start_ubx(self):
+        self.current_parse = "UBX"
+        self._n = 0
+        log.debug("received UBX start frame")
+
+    def _start_nmea(self):
+        self.current_parse = "NMEA"
+        self._buf[0] = G
+        self._n = 1
+        log.debug("received NMEA start frame")
 
     def ubx_msg(self, c, id, payload):
         '''generate a valid ubx message with checksum'''
-        sync = b'\xB5\x62'
-        print("payload", list(payload))
-        length = bytes([len(payload)])
-        if (len(length) < 2):
-            length += b'\x00'
-        msg = sync+c+id+length+payload
-        checksum = fletcher_checksum(msg)
-        msg += checksum
-        return msg
+        return ubx_frame(c, id, payload)
 
     def reset(self):
         '''force-reset the receiver. This will reset all configuration to default'''
-        msg = self.ubx_msg(b'\x06', b'\x04', b'\x00\x00\x00\x00')
-        print(f"msg:{msg}")
-        self.port.write(msg)
+        self.port.write(UBX_RESET_FRAME)
 
     def set_val(self, *args):
         '''set ubx config values'''
-        logging.debug(f"set val:{args}")
+        log.debug("set val:%s", args)
         if (len(args) % 2 != 0):
             raise ValueError("Number of arguments must be even!")
-        c = b'\x06'
-        id = b'\x8A'
-        payload = b'\x00\x01\x00\x00'
-        for arg in args:
-            if (type(arg) == int):
-                arg = bytes([arg])
-            elif (type(arg) == str):
-                arg = ubx_config_dict[arg]
-            payload += arg
-        msg = self.ubx_msg(c, id, payload)
+        try:
+            msg = _set_val_frame(*args)
+        except TypeError:
+            # unhashable arguments (e.g. bytearray) can not be cached
+            msg = _set_val_frame.__wrapped__(*args)
         # send the constructed ubx message to the receiver
-        print(f"msg:{msg}")
         self.port.write(msg)
-        logging.info("payload written")
+        log.info("payload written")
 
     def ubx_config_disable(self, *args):
         '''disable ubx messages (multiple strings as argument)'''
-        vals = []
-        for arg in args:
-            vals.append(ubx_config_dict[arg])
-            vals.append(b'\x00')
-        self.set_val(*vals)
+        self.set_val(*_config_vals(args, b'\x00'))
 
     def ubx_config_disable_all(self):
         '''disable all messages defined in config'''
-        self.ubx_config_disable(*list(ubx_config_dict.keys()))
+        self.port.write(self._ALL_DISABLE)
 
     def ubx_config_enable(self, *args):
         '''enable ubx messages (multiple strings as argument)'''
-        vals = []
-        for arg in args:
-            vals.append(ubx_config_dict[arg])
-            vals.append(b"\x01")
-        self.set_val(*vals)
+        self.set_val(*_config_vals(args, b"\x01"))
 
     def ubx_config_enable_all(self):
-        '''disable all messages defined in config'''
-        self.ubx_config_enable(*list(ubx_config_dict.keys()))
+        '''enable all messages defined in config'''
+        self.port.write(self._ALL_ENABLE)
 
 
 class UBX_message:
-    correct = False
+    __slots__ = ('correct', 'raw_data', 'ubx_class', 'ubx_class_name',
+                 'ubx_id', 'ubx_id_name', 'length', 'payload', 'checksum')
     sync = b'\xB5\x62'
-    raw_data = None
-    ubx_class = None
-    ubx_class_name = None
-    ubx_id = None
-    ubx_id_name = None
-    length = None
-    payload = None
-    checksum = None
 
     def __init__(self, data):
+        self.correct = False
+        self.ubx_class = self.ubx_class_name = None
+        self.ubx_id = self.ubx_id_name = None
+        self.length = self.payload = self.checksum = None
         if type(data) == list:
             data = bytes(data)
         if data[:2] == self.sync:
@@ -271,36 +439,35 @@ class UBX_message:
         self.raw_data = self.sync+data
 
         checksum = fletcher_checksum(self.raw_data[:-2])
-        if list(checksum) != list(data[-2:]):
+        if checksum != data[-2:]:
             raise ValueError(
-                f"wrong checksum {list(checksum)} is not {list(data[-2:])}")
+                f"wrong checksum {checksum.hex()} is not {data[-2:].hex()}")
         else:
             self.correct = True
-            self.ubx_class = data[0]
-            self.ubx_class_name = safeget(ubx_msg_dict, bytes(
-                [self.ubx_class]), "classname") or "unknown"
-            self.ubx_id = data[1]
-            self.ubx_id_name = safeget(ubx_msg_dict, bytes(
-                [self.ubx_class]), bytes([self.ubx_id])) or "unknown"
-            self.length = int.from_bytes(data[2:4], 'little')
-            self.payload = data[4:-2]
-            if (len(self.payload) != self.length):
+            # 4 header and 2 checksum bytes around the payload
+            if (len(data) < 6):
                 raise ValueError(
-                    f"payload length is incorrect ({len(self.payload)} != {self.length})")
+                    f"payload length is incorrect (frame of {len(data)} bytes after sync is shorter than 6)")
+            self.ubx_class, self.ubx_id, self.length = _UBX_HDR.unpack_from(
+                data, 0)
+            self.ubx_class_name = _UBX_CLASS.get(self.ubx_class, "unknown")
+            self.ubx_id_name = _UBX_NAME.get(
+                (self.ubx_class, self.ubx_id), "unknown")
+            if (len(data) - 6 != self.length):
+                raise ValueError(
+                    f"payload length is incorrect ({len(data) - 6} != {self.length})")
+            self.payload = data[4:4 + self.length]
 
     def __str__(self):
         return f"ubx message (class:{self.ubx_class_name} id:{self.ubx_id_name} payload_length: {self.length})"
 
 
 class NMEA_message:
-    correct = False
-    data = None
-    raw_data = None
-    talker_id = None
-    msg_type = None
-    checksum = None
+    __slots__ = ('correct', 'data', 'raw_data', 'talker_id', 'msg_type',
+                 'checksum')
 
     def __init__(self, data):
+        self.correct = False
         if type(data) != str:
             data = data.decode()
         self.raw_data = data
@@ -308,14 +475,13 @@ class NMEA_message:
         self.msg_type = data[2:5]
         self.data = data[6:-5]
         nmea_data, chk = data.split('*')
-        checksum = 0
-        for s in nmea_data:  # NMEA checksum is XOR sum of all characters between $ and *
-            checksum ^= ord(s)
-        checksum = hex(checksum)
+        checksum = nmea_checksum(nmea_data)
         self.checksum = chk[:-2]
-        parsed_checksum = hex(int(self.checksum, 16))
+        parsed_checksum = int(self.checksum, 16)
         if checksum != parsed_checksum:
-            raise ValueError(f"checksum {checksum} is not {parsed_checksum}")
+            raise ValueError(
+                f"checksum {hex(checksum)} is not {hex(parsed_checksum)}")
+        self.correct = True
 
     def __str__(self):
         return f"NMEA message (talkerID:{self.talker_id} type:{self.msg_type} data: {self.data} checksum {self.checksum})"